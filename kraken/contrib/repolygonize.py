@@ -4,8 +4,135 @@ Reads in a bunch of ALTO documents and repolygonizes the lines contained with
 the kraken polygonizer.
 """
 
+import os
 import click
 
+import numpy as np
+
+from lxml import etree
+from functools import partial
+from os.path import splitext
+
+
+# lenient parser without lxml's default tree size limits
+_xml_parser = etree.XMLParser(recover=True, huge_tree=True)
+
+# precompiled per-line lookups to avoid recompiling the path expressions
+# for every TextLine
+_alto_polygon_xp = etree.XPath("./*[local-name() = 'Shape']/*[local-name() = 'Polygon']")
+_page_coords_xp = etree.XPath("./*[local-name() = 'Coords']")
+
+
+def _format_alto_points(polygon):
+    """
+    Formats a polygon as a flat ALTO POINTS attribute value (`x0 y0 x1 y1 ...`).
+    """
+    return ' '.join(np.asarray(polygon, dtype=np.int32).ravel().astype('U'))
+
+
+def _format_page_points(polygon):
+    """
+    Formats a polygon as a PageXML points attribute value (`x0,y0 x1,y1 ...`).
+    """
+    pts = np.asarray(polygon, dtype=np.int32).astype('U')
+    return ' '.join(np.char.add(np.char.add(pts[:, 0], ','), pts[:, 1]))
+
+
+def _repl_alto(fname, polygons):
+    with open(fname, 'rb') as fp:
+        doc = etree.parse(fp, _xml_parser)
+        poly_it = iter(polygons)
+        for line in doc.iter('{*}TextLine'):
+            # mirror parse_alto which drops lines without BASELINE attribute
+            if line.get('BASELINE') is None:
+                continue
+            polygon = next(poly_it)
+            if polygon is not None:
+                pol = next(iter(_alto_polygon_xp(line)), None)
+                if pol is not None:
+                    pol.attrib['POINTS'] = _format_alto_points(polygon)
+        with open(splitext(fname)[0] + '_rewrite.xml', 'wb') as fp:
+            doc.write(fp, encoding='UTF-8', xml_declaration=True)
+
+
+def _page_line_parses(line):
+    """
+    Mirrors the conditions under which parse_page emits a line: a Baseline
+    element with non-blank points that parse to a coordinate list.
+    """
+    base = line.find('./{*}Baseline')
+    if base is None:
+        return False
+    points = base.get('points')
+    if points is None or points.isspace() or not len(points):
+        return False
+    try:
+        np.array(points.replace(',', ' ').split(), dtype=int).reshape(-1, 2)
+    except Exception:
+        return False
+    return True
+
+
+def _repl_page(fname, polygons):
+    with open(fname, 'rb') as fp:
+        doc = etree.parse(fp, _xml_parser)
+        # only lines parse_page emitted received a polygon so the filter has
+        # to match its parse conditions exactly to keep writeback aligned
+        lines = [line for line in doc.iter('{*}TextLine') if _page_line_parses(line)]
+        if len(lines) != len(polygons):
+            click.echo('Not rewriting {}: {} parseable lines in document but '
+                       '{} polygons calculated'.format(fname, len(lines), len(polygons)), err=True)
+            return
+        for line, polygon in zip(lines, polygons):
+            if polygon is not None:
+                pol = next(iter(_page_coords_xp(line)), None)
+                if pol is not None:
+                    pol.attrib['points'] = _format_page_points(polygon)
+        with open(splitext(fname)[0] + '_rewrite.xml', 'wb') as fp:
+            doc.write(fp, encoding='UTF-8', xml_declaration=True)
+
+
+def _process_document(doc, format_type, topline):
+    # keep kraken imports inside the worker so pool children only pay for
+    # them once they actually process a document
+    import mmap
+
+    from PIL import Image
+
+    from kraken.lib import xml
+    from kraken.lib.segmentation import calculate_polygonal_environment
+
+    if format_type == 'page':
+        parse_fn = xml.parse_page
+        repl_fn = _repl_page
+    else:
+        parse_fn = xml.parse_alto
+        repl_fn = _repl_alto
+
+    seg = parse_fn(doc)
+    # decode from a memory-mapped buffer to avoid small buffered reads on
+    # large page images
+    with open(seg['image'], 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        im = Image.open(buf)
+        # ask the decoder for grayscale output directly where supported (JPEG)
+        im.draft('L', im.size)
+        if im.mode != 'L':
+            im = im.convert('L')
+        else:
+            im.load()
+    valid = [(idx, x['baseline']) for idx, x in enumerate(seg['lines']) if x['baseline'] is not None]
+    o = calculate_polygonal_environment(im, [bl for _, bl in valid],
+                                        scale=(1800, 0), topline=topline)
+    # reassemble output in parse order as contiguous int32 arrays, leaving
+    # lines without baseline (or failed polygonizations) as None
+    polygons = [None] * len(seg['lines'])
+    for (idx, _), polygon in zip(valid, o):
+        if polygon is not None:
+            polygons[idx] = np.asarray(polygon, dtype=np.int32)
+    repl_fn(doc, polygons)
+    return doc
+
+
 @click.command()
 @click.option('-f', '--format-type', type=click.Choice(['alto', 'page']), default='alto',
               help='Sets the input document format. In ALTO and PageXML mode all '
@@ -18,8 +145,11 @@ import click
                    ' centerline for scripts annotated with a central line.')
 @click.option('-cl', '--centerline', 'topline', flag_value='centerline')
 @click.option('-bl', '--baseline', 'topline', flag_value='baseline', default='baseline')
-@click.argument('files', nargs=-1)
-def cli(format_type, topline, files):
+@click.option('-j', '--jobs', show_default=True, type=click.IntRange(1),
+              default=max(1, (os.cpu_count() or 1) - 1),
+              help='Number of documents processed in parallel.')
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def cli(format_type, topline, jobs, files):
     """
     A small script repolygonizing line boundaries in ALTO or PageXML files.
     """
@@ -28,64 +158,24 @@ def cli(format_type, topline, files):
         click.echo(ctx.get_help())
         ctx.exit()
 
-    import os
-    import numpy as np
-    import sys
-    from lxml import etree
-    from os.path import splitext
-
-    from kraken.lib import xml
-    from kraken import serialization, rpred
-    from PIL import Image
-    from kraken.lib.segmentation import calculate_polygonal_environment, scale_polygonal_lines
-
-    def _repl_alto(fname, polygons):
-        with open(fname, 'rb') as fp:
-            doc = etree.parse(fp)
-            lines = doc.findall('.//{*}TextLine')
-            idx = 0
-            for line in lines:
-                pol = line.find('./{*}Shape/{*}Polygon')
-                if pol is not None:
-                    pol.attrib['POINTS'] = ' '.join([str(coord) for pt in polygons[idx] for coord in pt])
-                    idx += 1
-            with open(splitext(fname)[0] + '_rewrite.xml', 'wb') as fp:
-                doc.write(fp, encoding='UTF-8', xml_declaration=True)
-
-    def _repl_page(fname, polygons):
-        with open(fname, 'rb') as fp:
-            doc = etree.parse(fp)
-            lines = doc.findall('.//{*}TextLine')
-            idx = 0
-            for line in lines:
-                pol = line.find('./{*}Coords')
-                if pol is not None:
-                    pol.attrib['points'] = ' '.join([','.join([str(x) for x in pt]) for pt in o[idx]])
-                    idx += 1
-            with open(splitext(fname)[0] + '_rewrite.xml', 'wb') as fp:
-                doc.write(fp, encoding='UTF-8', xml_declaration=True)
-
-    if format_type == 'page':
-        parse_fn = xml.parse_page
-        repl_fn = _repl_page
-    else:
-        parse_fn = xml.parse_alto
-        repl_fn = _repl_alto
-
     topline = {'topline': True,
                'baseline': False,
                'centerline': None}[topline]
 
-    for doc in files:
-        click.echo(f'Processing {doc} ', nl=False)
-        seg = parse_fn(doc)
-        im = Image.open(seg['image']).convert('L')
-        l = []
-        for x in seg['lines']:
-            bl = x['baseline'] if x['baseline'] is not None else [0, 0]
-            l.append(bl)
-        o = calculate_polygonal_environment(im, l, scale=(1800, 0), topline=topline)
-        repl_fn(doc, o)
+    worker = partial(_process_document, format_type=format_type, topline=topline)
+    if jobs == 1:
+        with click.progressbar(files, label='Repolygonizing') as bar:
+            for doc in bar:
+                worker(doc)
+    else:
+        import multiprocessing
+        with multiprocessing.Pool(jobs) as pool:
+            with click.progressbar(pool.imap_unordered(worker, files),
+                                   label='Repolygonizing',
+                                   length=len(files)) as bar:
+                for _ in bar:
+                    pass
+
 
 if __name__ == '__main__':
     cli()
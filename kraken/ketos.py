@@ -13,6 +13,7 @@
 # or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 import os
+import re
 import glob
 import uuid
 import click
@@ -21,7 +22,6 @@ import unicodedata
 
 from PIL import Image
 from rich.traceback import install
-from bidi.algorithm import get_display
 
 from typing import cast, Set, List, IO, Any, Dict
 
@@ -46,8 +46,48 @@ install(suppress=[click])
 Image.MAX_IMAGE_PIXELS = 20000 ** 2
 
 
+# CPU-aware default for dataloader workers/OpenMP threads, leaving one core
+# for the main process and capping at 8 to avoid oversubscription on large
+# hosts; sched_getaffinity respects cgroup/affinity limits where available
+try:
+    _available_cpus = len(os.sched_getaffinity(0))
+except AttributeError:
+    _available_cpus = os.cpu_count() or 1
+_workers_default = max(1, min(8, _available_cpus - 1))
+
+# choice sets shared between the train/segtrain/test option stacks
+_optimizer_choices = click.Choice(['Adam', 'SGD', 'RMSprop', 'Lamb'])
+_schedule_choices = click.Choice(['constant', '1cycle', 'exponential', 'cosine', 'step', 'reduceonplateau'])
+_normalization_choices = click.Choice(['NFD', 'NFKD', 'NFC', 'NFKC'])
+
+# help strings shared verbatim between the train/segtrain/test option stacks
+_repolygonize_help = ('Repolygonizes line data in ALTO/PageXML files. This '
+                      'ensures that the trained model is compatible with the '
+                      'segmenter in kraken even if the original image files '
+                      'either do not contain anything but transcriptions and '
+                      'baseline information or the polygon data was created '
+                      'using a different method. Will be ignored in `path` '
+                      'mode. Note that this option will be slow and will not '
+                      'scale input images to the same size as the segmenter '
+                      'does.')
+_force_binarization_help = ('Forces input images to be binary, otherwise the '
+                            'appropriate color format will be auto-determined '
+                            'through the network specification. Will be '
+                            'ignored in `path` mode.')
+
+# maps the -tl/-cl/-bl flag values to the polygonizer's topline argument
+_topline_locs = {'topline': True,
+                 'baseline': False,
+                 'centerline': None}
+
+
+# whether message() output is enabled. Cached once after the log level is
+# configured in cli() so the logger hierarchy isn't walked on every call.
+_message_enabled = logger.getEffectiveLevel() >= 30
+
+
 def message(msg, **styles):
-    if logger.getEffectiveLevel() >= 30:
+    if _message_enabled:
         click.secho(msg, **styles)
 
 
@@ -66,28 +106,163 @@ def cli(ctx, verbose, seed):
         manual_seed(seed)
 
     ctx.meta['verbose'] = verbose
+    ctx.meta['seed'] = seed
     log.set_logger(logger, level=30 - min(10 * verbose, 20))
+    global _message_enabled
+    _message_enabled = logger.getEffectiveLevel() >= 30
 
 
 def _validate_manifests(ctx, param, value):
     images = []
     for manifest in value:
-        for entry in manifest.readlines():
+        for entry in manifest:
             im_p = entry.rstrip('\r\n')
             if os.path.isfile(im_p):
                 images.append(im_p)
             else:
-                logger.warning('Invalid entry "{}" in {}'.format(im_p, manifest.name))
+                logger.warning('Invalid entry "%s" in %s', im_p, manifest.name)
     return images
 
 
 def _expand_gt(ctx, param, value):
     images = []
+    seen = set()
     for expression in value:
-        images.extend([x for x in glob.iglob(expression, recursive=True) if os.path.isfile(x)])
+        for im_p in glob.iglob(expression, recursive=True):
+            if im_p not in seen and os.path.isfile(im_p):
+                seen.add(im_p)
+                images.append(im_p)
     return images
 
 
+def _common_hyper_params(freq, quit, epochs, min_epochs, lag, min_delta,
+                         optimizer, lrate, momentum, weight_decay, schedule,
+                         gamma, step_size, sched_patience, cos_max, augment):
+    """
+    Builds the hyperparameter payload shared between the train and segtrain
+    commands.
+    """
+    return {'freq': freq,
+            'quit': quit,
+            'epochs': epochs,
+            'min_epochs': min_epochs,
+            'lag': lag,
+            'min_delta': min_delta,
+            'optimizer': optimizer,
+            'lrate': lrate,
+            'momentum': momentum,
+            'weight_decay': weight_decay,
+            'schedule': schedule,
+            'gamma': gamma,
+            'step_size': step_size,
+            'rop_patience': sched_patience,
+            'cos_t_max': cos_max,
+            'augment': augment}
+
+
+def _preload_augmentation():
+    """
+    Imports albumentations in a background thread so dataset construction
+    doesn't block on it later. Import errors are left for the datasets to
+    report.
+    """
+    import threading
+    import importlib
+
+    def _import():
+        try:
+            importlib.import_module('albumentations')
+        except ImportError:
+            pass
+
+    threading.Thread(target=_import, daemon=True).start()
+
+
+def _init_line_pool(font, font_size, font_weight, language, seed=None):
+    """
+    Pool initializer building one LineGenerator per worker process, as the
+    underlying pango/cairo state is not picklable.
+
+    Also reseeds numpy in each worker: forked workers inherit identical RNG
+    state and would otherwise draw identical degradation parameters.
+    """
+    global _line_pool_lg
+    import numpy as np
+
+    from multiprocessing import current_process
+
+    from kraken import linegen
+
+    identity = current_process()._identity
+    rank = identity[0] if identity else 0
+    if rank:
+        if seed is not None:
+            np.random.seed(seed + rank)
+        else:
+            np.random.seed()
+    _line_pool_lg = linegen.LineGenerator(font, font_size, font_weight, language)
+
+
+def _render_text_line(task, renormalize, disable_degradation, legacy, alpha,
+                      beta, distort, distortion_sigma, output, reorder):
+    """
+    Pool worker rendering, degrading, and writing a single synthetic line.
+
+    Returns an error message for failed renders, None otherwise.
+    """
+    import numpy as np
+
+    from bidi.algorithm import get_display
+
+    from kraken import linegen
+
+    idx, line = task
+    try:
+        if renormalize:
+            im = _line_pool_lg.render_line(unicodedata.normalize(renormalize, line))
+        else:
+            im = _line_pool_lg.render_line(line)
+    except KrakenCairoSurfaceException as e:
+        return '{}: {} {}'.format(e.message, e.width, e.height)
+    if not disable_degradation and not legacy:
+        im = linegen.degrade_line(im, alpha=alpha, beta=beta)
+        im = linegen.distort_line(im, abs(np.random.normal(distort)), abs(np.random.normal(distortion_sigma)))
+    elif legacy:
+        im = linegen.ocropy_degrade(im)
+    im.save('{}/{:06d}.png'.format(output, idx))
+    with open('{}/{:06d}.gt.txt'.format(output, idx), 'wb') as fp:
+        if reorder:
+            fp.write(get_display(line).encode('utf-8'))
+        else:
+            fp.write(line.encode('utf-8'))
+    return None
+
+
+_cuda_device_re = re.compile(r'cuda(?::(\d+))?$')
+
+
+def _device_to_gpus(device):
+    """
+    Parses a device string into the trainer's gpus argument.
+    """
+    if device == 'cpu':
+        return None
+    m = _cuda_device_re.match(device)
+    if m:
+        return [int(m.group(1) or 0)]
+    return device
+
+
+def _val_check_interval(freq):
+    """
+    Normalizes the validation frequency into the matching trainer keyword
+    argument.
+    """
+    if freq > 1:
+        return {'check_val_every_n_epoch': int(freq)}
+    return {'val_check_interval': freq}
+
+
 def _validate_merging(ctx, param, value):
     """
     Maps baseline/region merging to a dict of merge structures.
@@ -95,12 +270,11 @@ def _validate_merging(ctx, param, value):
     if not value:
         return None
     merge_dict = {}  # type: Dict[str, str]
-    try:
-        for m in value:
-            k, v = m.split(':')
-            merge_dict[v] = k  # type: ignore
-    except Exception:
-        raise click.BadParameter('Mappings must be in format target:src')
+    for m in value:
+        k, sep, v = m.partition(':')
+        if not sep or not k or not v or ':' in v:
+            raise click.BadParameter('Mappings must be in format target:src')
+        merge_dict[v] = k
     return merge_dict
 
 
@@ -149,10 +323,7 @@ def _validate_merging(ctx, param, value):
 @click.option('--optimizer',
               show_default=True,
               default=SEGMENTATION_HYPER_PARAMS['optimizer'],
-              type=click.Choice(['Adam',
-                                 'SGD',
-                                 'RMSprop',
-                                 'Lamb']),
+              type=_optimizer_choices,
               help='Select optimizer')
 @click.option('-r', '--lrate', show_default=True, default=SEGMENTATION_HYPER_PARAMS['lrate'], help='Learning rate')
 @click.option('-m', '--momentum', show_default=True, default=SEGMENTATION_HYPER_PARAMS['momentum'], help='Momentum')
@@ -160,12 +331,7 @@ def _validate_merging(ctx, param, value):
               default=SEGMENTATION_HYPER_PARAMS['weight_decay'], help='Weight decay')
 @click.option('--schedule',
               show_default=True,
-              type=click.Choice(['constant',
-                                 '1cycle',
-                                 'exponential',
-                                 'cosine',
-                                 'step',
-                                 'reduceonplateau']),
+              type=_schedule_choices,
               default=SEGMENTATION_HYPER_PARAMS['schedule'],
               help='Set learning rate scheduler. For 1cycle, cycle length is determined by the `--step-size` option.')
 @click.option('-g',
@@ -194,13 +360,11 @@ def _validate_merging(ctx, param, value):
 @click.option('-e', '--evaluation-files', show_default=True, default=None, multiple=True,
               callback=_validate_manifests, type=click.File(mode='r', lazy=True),
               help='File(s) with paths to evaluation data. Overrides the `-p` parameter')
-@click.option('--workers', show_default=True, default=1, help='Number of OpenMP threads and workers when running on CPU.')
+@click.option('--workers', show_default=True, default=_workers_default, help='Number of OpenMP threads and workers when running on CPU.')
 @click.option('--load-hyper-parameters/--no-load-hyper-parameters', show_default=True, default=False,
               help='When loading an existing model, retrieve hyper-parameters from the model')
 @click.option('--force-binarization/--no-binarization', show_default=True,
-              default=False, help='Forces input images to be binary, otherwise '
-              'the appropriate color format will be auto-determined through the '
-              'network specification. Will be ignored in `path` mode.')
+              default=False, help=_force_binarization_help)
 @click.option('-f', '--format-type', type=click.Choice(['path', 'xml', 'alto', 'page']), default='xml',
               help='Sets the training data format. In ALTO and PageXML mode all '
               'data is extracted from xml files containing both baselines and a '
@@ -262,6 +426,9 @@ def segtrain(ctx, output, spec, line_width, load, freq, quit, epochs, min_epochs
 
     from kraken.lib.train import SegmentationModel, KrakenTrainer
 
+    if augment:
+        _preload_augmentation()
+
     if resize != 'fail' and not load:
         raise click.BadOptionUsage('resize', 'resize option requires loading an existing model')
 
@@ -272,23 +439,12 @@ def segtrain(ctx, output, spec, line_width, load, freq, quit, epochs, min_epochs
 
     # populate hyperparameters from command line args
     hyper_params = SEGMENTATION_HYPER_PARAMS.copy()
-    hyper_params.update({'line_width': line_width,
-                         'freq': freq,
-                         'quit': quit,
-                         'epochs': epochs,
-                         'min_epochs': min_epochs,
-                         'lag': lag,
-                         'min_delta': min_delta,
-                         'optimizer': optimizer,
-                         'lrate': lrate,
-                         'momentum': momentum,
-                         'weight_decay': weight_decay,
-                         'schedule': schedule,
-                         'augment': augment,
-                         'gamma': gamma,
-                         'step_size': step_size,
-                         'rop_patience': sched_patience,
-                         'cos_t_max': cos_max})
+    hyper_params.update(_common_hyper_params(freq, quit, epochs, min_epochs,
+                                             lag, min_delta, optimizer, lrate,
+                                             momentum, weight_decay, schedule,
+                                             gamma, step_size, sched_patience,
+                                             cos_max, augment))
+    hyper_params['line_width'] = line_width
 
     # disable automatic partition when given evaluation set explicitly
     if evaluation_files:
@@ -302,21 +458,11 @@ def segtrain(ctx, output, spec, line_width, load, freq, quit, epochs, min_epochs
     if len(ground_truth) == 0:
         raise click.UsageError('No training data was provided to the train command. Use `-t` or the `ground_truth` argument.')
 
-    loc = {'topline': True,
-           'baseline': False,
-           'centerline': None}
+    topline = _topline_locs[topline]
 
-    topline = loc[topline]
+    device = _device_to_gpus(device)
 
-    if device == 'cpu':
-        device = None
-    elif device.startswith('cuda'):
-        device = [int(device.split(':')[-1])]
-
-    if hyper_params['freq'] > 1:
-        val_check_interval = {'check_val_every_n_epoch': int(hyper_params['freq'])}
-    else:
-        val_check_interval = {'val_check_interval': hyper_params['freq']}
+    val_check_interval = _val_check_interval(hyper_params['freq'])
 
     model = SegmentationModel(hyper_params,
                               output=output,
@@ -411,10 +557,7 @@ def segtrain(ctx, output, spec, line_width, load, freq, quit, epochs, min_epochs
 @click.option('--optimizer',
               show_default=True,
               default=RECOGNITION_HYPER_PARAMS['optimizer'],
-              type=click.Choice(['Adam',
-                                 'SGD',
-                                 'RMSprop',
-                                 'Lamb']),
+              type=_optimizer_choices,
               help='Select optimizer')
 @click.option('-r', '--lrate', show_default=True, default=RECOGNITION_HYPER_PARAMS['lrate'], help='Learning rate')
 @click.option('-m', '--momentum', show_default=True, default=RECOGNITION_HYPER_PARAMS['momentum'], help='Momentum')
@@ -422,12 +565,7 @@ def segtrain(ctx, output, spec, line_width, load, freq, quit, epochs, min_epochs
               default=RECOGNITION_HYPER_PARAMS['weight_decay'], help='Weight decay')
 @click.option('--schedule',
               show_default=True,
-              type=click.Choice(['constant',
-                                 '1cycle',
-                                 'exponential',
-                                 'cosine',
-                                 'step',
-                                 'reduceonplateau']),
+              type=_schedule_choices,
               default=RECOGNITION_HYPER_PARAMS['schedule'],
               help='Set learning rate scheduler. For 1cycle, cycle length is determined by the `--epoch` option.')
 @click.option('-g',
@@ -452,7 +590,7 @@ def segtrain(ctx, output, spec, line_width, load, freq, quit, epochs, min_epochs
               help='Ground truth data partition ratio between train/validation set')
 @click.option('--fixed-splits/--ignore-fixed-split', show_default=True, default=False,
               help='Whether to honor fixed splits in binary datasets.')
-@click.option('-u', '--normalization', show_default=True, type=click.Choice(['NFD', 'NFKD', 'NFC', 'NFKC']),
+@click.option('-u', '--normalization', show_default=True, type=_normalization_choices,
               default=RECOGNITION_HYPER_PARAMS['normalization'], help='Ground truth normalization')
 @click.option('-n', '--normalize-whitespace/--no-normalize-whitespace', show_default=True,
               default=RECOGNITION_HYPER_PARAMS['normalize_whitespace'], help='Normalizes unicode whitespace')
@@ -475,22 +613,13 @@ def segtrain(ctx, output, spec, line_width, load, freq, quit, epochs, min_epochs
 @click.option('-e', '--evaluation-files', show_default=True, default=None, multiple=True,
               callback=_validate_manifests, type=click.File(mode='r', lazy=True),
               help='File(s) with paths to evaluation data. Overrides the `-p` parameter')
-@click.option('--workers', show_default=True, default=1, help='Number of OpenMP threads and workers when running on CPU.')
+@click.option('--workers', show_default=True, default=_workers_default, help='Number of OpenMP threads and workers when running on CPU.')
 @click.option('--load-hyper-parameters/--no-load-hyper-parameters', show_default=True, default=False,
               help='When loading an existing model, retrieve hyperparameters from the model')
 @click.option('--repolygonize/--no-repolygonize', show_default=True,
-              default=False, help='Repolygonizes line data in ALTO/PageXML '
-              'files. This ensures that the trained model is compatible with the '
-              'segmenter in kraken even if the original image files either do '
-              'not contain anything but transcriptions and baseline information '
-              'or the polygon data was created using a different method. Will '
-              'be ignored in `path` mode. Note that this option will be slow '
-              'and will not scale input images to the same size as the segmenter '
-              'does.')
+              default=False, help=_repolygonize_help)
 @click.option('--force-binarization/--no-binarization', show_default=True,
-              default=False, help='Forces input images to be binary, otherwise '
-              'the appropriate color format will be auto-determined through the '
-              'network specification. Will be ignored in `path` mode.')
+              default=False, help=_force_binarization_help)
 @click.option('-f', '--format-type', type=click.Choice(['path', 'xml', 'alto', 'page', 'binary']), default='path',
               help='Sets the training data format. In ALTO and PageXML mode all '
               'data is extracted from xml files containing both line definitions and a '
@@ -526,27 +655,19 @@ def train(ctx, batch_size, pad, output, spec, append, load, freq, quit, epochs,
     import shutil
     from kraken.lib.train import RecognitionModel, KrakenTrainer
 
+    if augment:
+        _preload_augmentation()
+
     hyper_params = RECOGNITION_HYPER_PARAMS.copy()
-    hyper_params.update({'freq': freq,
-                         'pad': pad,
+    hyper_params.update(_common_hyper_params(freq, quit, epochs, min_epochs,
+                                             lag, min_delta, optimizer, lrate,
+                                             momentum, weight_decay, schedule,
+                                             gamma, step_size, sched_patience,
+                                             cos_max, augment))
+    hyper_params.update({'pad': pad,
                          'batch_size': batch_size,
-                         'quit': quit,
-                         'epochs': epochs,
-                         'min_epochs': min_epochs,
-                         'lag': lag,
-                         'min_delta': min_delta,
-                         'optimizer': optimizer,
-                         'lrate': lrate,
-                         'momentum': momentum,
-                         'weight_decay': weight_decay,
-                         'schedule': schedule,
-                         'gamma': gamma,
-                         'step_size': step_size,
-                         'rop_patience': sched_patience,
-                         'cos_t_max': cos_max,
                          'normalization': normalization,
-                         'normalize_whitespace': normalize_whitespace,
-                         'augment': augment})
+                         'normalize_whitespace': normalize_whitespace})
 
     # disable automatic partition when given evaluation set explicitly
     if evaluation_files:
@@ -567,15 +688,9 @@ def train(ctx, batch_size, pad, output, spec, append, load, freq, quit, epochs,
         logger.debug(f'Loading codec file from {codec}')
         codec = json.load(codec)
 
-    if device == 'cpu':
-        device = None
-    elif device.startswith('cuda'):
-        device = [int(device.split(':')[-1])]
+    device = _device_to_gpus(device)
 
-    if hyper_params['freq'] > 1:
-        val_check_interval = {'check_val_every_n_epoch': int(hyper_params['freq'])}
-    else:
-        val_check_interval = {'val_check_interval': hyper_params['freq']}
+    val_check_interval = _val_check_interval(hyper_params['freq'])
 
     model = RecognitionModel(hyper_params=hyper_params,
                              output=output,
@@ -628,30 +743,24 @@ def train(ctx, batch_size, pad, output, spec, append, load, freq, quit, epochs,
 @click.option('-d', '--device', show_default=True, default='cpu', help='Select device to use (cpu, cuda:0, cuda:1, ...)')
 @click.option('--pad', show_default=True, type=click.INT, default=16, help='Left and right '
               'padding around lines')
-@click.option('--workers', show_default=True, default=1, help='Number of OpenMP threads when running on CPU.')
+@click.option('--workers', show_default=True, default=_workers_default, help='Number of OpenMP threads when running on CPU.')
 @click.option('--reorder/--no-reorder', show_default=True, default=True, help='Reordering of code points to display order')
 @click.option('--base-dir', show_default=True, default='auto',
               type=click.Choice(['L', 'R', 'auto']), help='Set base text '
               'direction.  This should be set to the direction used during the '
               'creation of the training data. If set to `auto` it will be '
               'overridden by any explicit value given in the input files.')
-@click.option('-u', '--normalization', show_default=True, type=click.Choice(['NFD', 'NFKD', 'NFC', 'NFKC']),
+@click.option('-u', '--normalization', show_default=True, type=_normalization_choices,
               default=None, help='Ground truth normalization')
 @click.option('-n', '--normalize-whitespace/--no-normalize-whitespace',
               show_default=True, default=True, help='Normalizes unicode whitespace')
 @click.option('--repolygonize/--no-repolygonize', show_default=True,
-              default=False, help='Repolygonizes line data in ALTO/PageXML '
-              'files. This ensures that the trained model is compatible with the '
-              'segmenter in kraken even if the original image files either do '
-              'not contain anything but transcriptions and baseline information '
-              'or the polygon data was created using a different method. Will '
-              'be ignored in `path` mode. Note, that this option will be slow '
-              'and will not scale input images to the same size as the segmenter '
-              'does.')
+              default=False, help=_repolygonize_help)
 @click.option('--force-binarization/--no-binarization', show_default=True,
-              default=False, help='Forces input images to be binary, otherwise '
-              'the appropriate color format will be auto-determined through the '
-              'network specification. Will be ignored in `path` mode.')
+              default=False, help=_force_binarization_help)
+@click.option('--quantize/--no-quantize', show_default=True, default=False,
+              help='Apply INT8 dynamic quantization to LSTM/Linear layers for '
+              'CPU evaluation. Faster but may degrade accuracy; verify per model.')
 @click.option('-f', '--format-type', type=click.Choice(['path', 'xml', 'alto', 'page', 'binary']), default='path',
               help='Sets the training data format. In ALTO and PageXML mode all '
               'data is extracted from xml files containing both baselines and a '
@@ -662,13 +771,14 @@ def train(ctx, batch_size, pad, output, spec, append, load, freq, quit, epochs,
 @click.argument('test_set', nargs=-1, callback=_expand_gt, type=click.Path(exists=False, dir_okay=False))
 def test(ctx, batch_size, model, evaluation_files, device, pad, workers,
          reorder, base_dir, normalization, normalize_whitespace, repolygonize,
-         force_binarization, format_type, test_set):
+         force_binarization, quantize, format_type, test_set):
     """
     Evaluate on a test set.
     """
     if not model:
         raise click.UsageError('No model to evaluate given.')
 
+    import torch
     import numpy as np
     from torch.utils.data import DataLoader
 
@@ -689,10 +799,24 @@ def test(ctx, batch_size, model, evaluation_files, device, pad, workers,
         nn[p] = models.load_any(p)
         message('\u2713', fg='green')
 
+    if quantize:
+        if device != 'cpu':
+            logger.warning('Dynamic quantization is CPU-only. Ignoring --quantize.')
+        else:
+            for p, net in nn.items():
+                logger.info('Quantizing LSTM/Linear layers of {} to INT8'.format(p))
+                net.nn.nn = torch.quantization.quantize_dynamic(net.nn.nn,
+                                                                {torch.nn.LSTM, torch.nn.Linear},
+                                                                dtype=torch.qint8)
+
     test_set = list(test_set)
 
-    # set number of OpenMP threads
-    next(iter(nn.values())).nn.set_num_threads(1)
+    # balance intraop threads against DataLoader workers to avoid
+    # oversubscribing the host; the env vars propagate to worker processes
+    threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+    os.environ.setdefault('OMP_NUM_THREADS', str(threads))
+    os.environ.setdefault('MKL_NUM_THREADS', str(threads))
+    next(iter(nn.values())).nn.set_num_threads(threads)
 
     if evaluation_files:
         test_set.extend(evaluation_files)
@@ -704,6 +828,17 @@ def test(ctx, batch_size, model, evaluation_files, device, pad, workers,
         if repolygonize:
             message('Repolygonizing data')
         test_set = preparse_xml_data(test_set, format_type, repolygonize)
+
+        # sort by approximate line length so batches contain similarly sized
+        # lines, cutting padding waste in collate_sequences
+        def _line_width(rec):
+            baseline = rec.get('baseline')
+            if not baseline:
+                return 0
+            xs = [pt[0] for pt in baseline]
+            return max(xs) - min(xs)
+
+        test_set.sort(key=_line_width)
         valid_norm = False
         DatasetClass = PolygonGTDataset
     elif format_type == 'binary':
@@ -722,13 +857,34 @@ def test(ctx, batch_size, model, evaluation_files, device, pad, workers,
         test_set = [{'image': img} for img in test_set]
         valid_norm = True
 
+    if format_type != 'binary':
+        # drop lines with missing images up front; hitting them at batch time
+        # tears down and respawns DataLoader workers for each failure
+        exists = {}
+        for rec in test_set:
+            im_path = rec['image']
+            if im_path not in exists:
+                exists[im_path] = os.path.exists(im_path)
+        missing = [p for p, e in exists.items() if not e]
+        if missing:
+            logger.warning('Skipping missing image files: {}'.format(', '.join(str(p) for p in missing)))
+            test_set = [rec for rec in test_set if exists[rec['image']]]
+
     if len(test_set) == 0:
         raise click.UsageError('No evaluation data was provided to the test command. Use `-e` or the `test_set` argument.')
 
     if reorder and base_dir != 'auto':
         reorder = base_dir
 
+    if device.startswith('cuda'):
+        # the length-sorted batches keep input shapes near-constant so the
+        # autotuned conv algorithms get reused
+        torch.backends.cudnn.benchmark = True
+
     acc_list = []
+    # models with identical input specs share one dataset/loader so the test
+    # set is only ingested once per distinct input shape
+    loaders: Dict[tuple, Any] = {}
     for p, net in nn.items():
         algn_gt: List[str] = []
         algn_pred: List[str] = []
@@ -737,25 +893,30 @@ def test(ctx, batch_size, model, evaluation_files, device, pad, workers,
         message('Evaluating {}'.format(p))
         logger.info('Evaluating {}'.format(p))
         batch, channels, height, width = net.nn.input
-        ts = ImageInputTransforms(batch, height, width, channels, pad, valid_norm, force_binarization)
-        ds = DatasetClass(normalization=normalization,
-                          whitespace_normalization=normalize_whitespace,
-                          reorder=reorder,
-                          im_transforms=ts)
-        for line in test_set:
-            try:
-                ds.add(**line)
-            except KrakenInputException as e:
-                logger.info(e)
-        # don't encode validation set as the alphabets may not match causing encoding failures
-        ds.no_encode()
-        ds_loader = DataLoader(ds,
-                               batch_size=batch_size,
-                               num_workers=workers,
-                               pin_memory=True,
-                               collate_fn=collate_sequences)
-
-        with KrakenProgressBar() as progress:
+        spec = (batch, channels, height, width)
+        if spec not in loaders:
+            ts = ImageInputTransforms(batch, height, width, channels, pad, valid_norm, force_binarization)
+            ds = DatasetClass(normalization=normalization,
+                              whitespace_normalization=normalize_whitespace,
+                              reorder=reorder,
+                              im_transforms=ts)
+            for line in test_set:
+                try:
+                    ds.add(**line)
+                except KrakenInputException as e:
+                    logger.info(e)
+            # don't encode validation set as the alphabets may not match causing encoding failures
+            ds.no_encode()
+            loaders[spec] = DataLoader(ds,
+                                       batch_size=batch_size,
+                                       num_workers=workers,
+                                       pin_memory=device != 'cpu',
+                                       collate_fn=collate_sequences)
+        ds_loader = loaders[spec]
+
+        # inference_mode is only available from torch 1.9 onwards
+        no_autograd = getattr(torch, 'inference_mode', torch.no_grad)
+        with KrakenProgressBar() as progress, no_autograd():
             batches = len(ds_loader)
             pred_task = progress.add_task('Evaluating', total=batches, visible=True if not ctx.meta['verbose'] else False)
 
@@ -795,7 +956,7 @@ def test(ctx, batch_size, model, evaluation_files, device, pad, workers,
 @click.option('-b', '--binarize/--no-binarize', show_default=True, default=True,
               help='Binarize color/grayscale images')
 @click.option('-u', '--normalization', show_default=True,
-              type=click.Choice(['NFD', 'NFKD', 'NFC', 'NFKC']), default=None,
+              type=_normalization_choices, default=None,
               help='Normalize ground truth')
 @click.option('-s', '--normalize-whitespace/--no-normalize-whitespace',
               show_default=True, default=True, help='Normalizes unicode whitespace')
@@ -820,8 +981,10 @@ def extract(ctx, binarize, normalization, normalize_whitespace, reorder,
     import base64
 
     from io import BytesIO
+    from functools import partial
     from PIL import Image
-    from lxml import html, etree
+    from lxml import etree
+    from bidi.algorithm import get_display
 
     from kraken import binarization
 
@@ -832,9 +995,10 @@ def extract(ctx, binarize, normalization, normalize_whitespace, reorder,
 
     text_transforms = []
     if normalization:
-        text_transforms.append(lambda x: unicodedata.normalize(normalization, x))
+        text_transforms.append(partial(unicodedata.normalize, normalization))
     if normalize_whitespace:
-        text_transforms.append(lambda x: regex.sub(r'\s', ' ', x))
+        whitespace_re = regex.compile(r'\s')
+        text_transforms.append(lambda x: whitespace_re.sub(' ', x))
     if reorder:
         text_transforms.append(get_display)
 
@@ -846,17 +1010,18 @@ def extract(ctx, binarize, normalization, normalize_whitespace, reorder,
 
         for fp in transcriptions:
             logger.info('Reading {}'.format(fp.name))
-            doc = html.parse(fp)
-            etree.strip_tags(doc, etree.Comment)
-            td = doc.find(".//meta[@itemprop='text_direction']")
-            if td is None:
-                td = 'horizontal-lr'
-            else:
-                td = td.attrib['content']
-
+            # the transcription environments embed base64 page images so
+            # stream the document instead of materializing the whole DOM
+            td = 'horizontal-lr'
             im = None
             dest_dict = {'output': output, 'idx': 0, 'src': fp.name, 'uuid': str(uuid.uuid4())}
-            for section in doc.xpath('//section'):
+            for _, elem in etree.iterparse(fp.name, events=('end',), tag=('meta', 'section'), html=True):
+                if elem.tag == 'meta':
+                    if elem.get('itemprop') == 'text_direction':
+                        td = elem.attrib['content']
+                    continue
+                section = elem
+                etree.strip_tags(section, etree.Comment)
                 img = section.xpath('.//img')[0].get('src')
                 fd = BytesIO(base64.b64decode(img.split(',')[1]))
                 im = Image.open(fd)
@@ -866,7 +1031,10 @@ def extract(ctx, binarize, normalization, normalize_whitespace, reorder,
                 if binarize:
                     im = binarization.nlbin(im)
                 for line in section.iter('li'):
-                    if line.get('contenteditable') and (not u''.join(line.itertext()).isspace() and u''.join(line.itertext())):
+                    if not line.get('contenteditable'):
+                        continue
+                    text = u''.join(line.itertext())
+                    if text and not text.isspace():
                         dest_dict['idx'] = idx
                         dest_dict['uuid'] = str(uuid.uuid4())
                         logger.debug('Writing line {:06d}'.format(idx))
@@ -875,12 +1043,16 @@ def extract(ctx, binarize, normalization, normalize_whitespace, reorder,
                             im.rotate(90, expand=True)
                         l_img.save(('{output}/' + format + '.png').format(**dest_dict))
                         manifest.append((format + '.png').format(**dest_dict))
-                        text = u''.join(line.itertext()).strip()
+                        text = text.strip()
                         for func in text_transforms:
                             text = func(text)
                         with open(('{output}/' + format + '.gt.txt').format(**dest_dict), 'wb') as t:
                             t.write(text.encode('utf-8'))
                         idx += 1
+                # release the processed section and any preceding siblings
+                section.clear()
+                while section.getprevious() is not None:
+                    del section.getparent()[0]
 
             progress.update(read_task, advance=1)
 
@@ -949,8 +1121,13 @@ def transcription(ctx, text_direction, scale, bw, maxcolseps,
                 logger.warning('Input {} is in {} color mode. Converting to RGB'.format(fp.name, im.mode))
                 im = im.convert('RGB')
             logger.info('Binarizing page')
+            # nlbin output is already bitonal; segment and rpred accept the
+            # 'L'-mode form directly so skip the 1-bit packing pass. Bitonal
+            # P/RGB inputs short-circuit nlbin unconverted and still need
+            # normalization.
             im_bin = binarization.nlbin(im)
-            im_bin = im_bin.convert('1')
+            if im_bin.mode not in ('1', 'L'):
+                im_bin = im_bin.convert('1')
             logger.info('Segmenting page')
             if not lines:
                 res = pageseg.segment(im_bin, text_direction, scale, maxcolseps, black_colseps, pad=pad)
@@ -989,10 +1166,10 @@ def transcription(ctx, text_direction, scale, bw, maxcolseps,
 @click.option('-e', '--encoding', default='utf-8',
               help='Decode text files with given codec.')
 @click.option('-u', '--normalization',
-              type=click.Choice(['NFD', 'NFKD', 'NFC', 'NFKC']), default=None,
+              type=_normalization_choices, default=None,
               help='Normalize ground truth')
 @click.option('-ur', '--renormalize',
-              type=click.Choice(['NFD', 'NFKD', 'NFC', 'NFKC']), default=None,
+              type=_normalization_choices, default=None,
               help='Renormalize text for rendering purposes.')
 @click.option('--reorder/--no-reorder', default=False, help='Reorder code points to display order')
 @click.option('-fs', '--font-size', type=click.INT, default=32,
@@ -1018,20 +1195,23 @@ def transcription(ctx, text_direction, scale, bw, maxcolseps,
               'Gaussian kernel from')
 @click.option('--legacy/--no-legacy', default=False,
               help='Use ocropy-style degradations')
+@click.option('--workers', show_default=True, default=1, type=click.IntRange(1),
+              help='Number of parallel rendering processes.')
 @click.option('-o', '--output', type=click.Path(), default='training_data',
               help='Output directory')
 @click.argument('text', nargs=-1, type=click.Path(exists=True))
 def line_generator(ctx, font, maxlines, encoding, normalization, renormalize,
                    reorder, font_size, font_weight, language, max_length, strip,
                    disable_degradation, alpha, beta, distort, distortion_sigma,
-                   legacy, output, text):
+                   legacy, workers, output, text):
     """
     Generates artificial text line training data.
     """
     import errno
     import numpy as np
 
-    from kraken import linegen
+    from functools import partial
+
     from kraken.lib.util import make_printable
 
     lines: Set[str] = set()
@@ -1057,7 +1237,9 @@ def line_generator(ctx, font, maxlines, encoding, normalization, renormalize,
     if maxlines and maxlines < len(lines):
         message('Sampling {} lines\t'.format(maxlines), nl=False)
         llist = list(lines)
-        lines = set(llist[idx] for idx in np.random.randint(0, len(llist), maxlines))
+        # sample without replacement through the global RNG so we get
+        # maxlines distinct lines while still honoring `ketos --seed`
+        lines = set(llist[idx] for idx in np.random.choice(len(llist), maxlines, replace=False))
         message('\u2713', fg='green')
     try:
         os.makedirs(output)
@@ -1081,31 +1263,38 @@ def line_generator(ctx, font, maxlines, encoding, normalization, renormalize,
     message('Symbols: {}'.format(''.join(chars)))
     if combining:
         message('Combining Characters: {}'.format(', '.join(combining)))
-    lg = linegen.LineGenerator(font, font_size, font_weight, language)
+    render_fn = partial(_render_text_line,
+                        renormalize=renormalize,
+                        disable_degradation=disable_degradation,
+                        legacy=legacy,
+                        alpha=alpha,
+                        beta=beta,
+                        distort=distort,
+                        distortion_sigma=distortion_sigma,
+                        output=output,
+                        reorder=reorder)
     with KrakenProgressBar() as progress:
         gen_task = progress.add_task('Writing images', total=len(lines), visible=True if not ctx.meta['verbose'] else False)
-        for idx, line in enumerate(lines):
-            logger.info(line)
-            try:
-                if renormalize:
-                    im = lg.render_line(unicodedata.normalize(renormalize, line))
-                else:
-                    im = lg.render_line(line)
-            except KrakenCairoSurfaceException as e:
-                logger.info('{}: {} {}'.format(e.message, e.width, e.height))
-                continue
-            if not disable_degradation and not legacy:
-                im = linegen.degrade_line(im, alpha=alpha, beta=beta)
-                im = linegen.distort_line(im, abs(np.random.normal(distort)), abs(np.random.normal(distortion_sigma)))
-            elif legacy:
-                im = linegen.ocropy_degrade(im)
-            im.save('{}/{:06d}.png'.format(output, idx))
-            with open('{}/{:06d}.gt.txt'.format(output, idx), 'wb') as fp:
-                if reorder:
-                    fp.write(get_display(line).encode('utf-8'))
-                else:
-                    fp.write(line.encode('utf-8'))
-            progress.update(gen_task, advance=1)
+        if workers > 1:
+            import multiprocessing
+            # the pango/cairo render state is not picklable so each worker
+            # builds its own LineGenerator in the pool initializer
+            with multiprocessing.Pool(workers,
+                                      initializer=_init_line_pool,
+                                      initargs=(font, font_size, font_weight, language,
+                                                ctx.meta['seed'])) as pool:
+                for err in pool.imap_unordered(render_fn, enumerate(lines)):
+                    if err is not None:
+                        logger.info(err)
+                    progress.update(gen_task, advance=1)
+        else:
+            _init_line_pool(font, font_size, font_weight, language)
+            for task in enumerate(lines):
+                logger.info(task[1])
+                err = render_fn(task)
+                if err is not None:
+                    logger.info(err)
+                progress.update(gen_task, advance=1)
 
 @cli.command('publish')
 @click.pass_context
@@ -1186,7 +1375,7 @@ def publish(ctx, metadata, access_token, model):
 @cli.command('compile')
 @click.pass_context
 @click.option('-o', '--output', show_default=True, type=click.Path(), default='model', help='Output model file')
-@click.option('--workers', show_default=True, default=1, help='Number of OpenMP threads and workers when running on CPU.')
+@click.option('--workers', show_default=True, default=_workers_default, help='Number of OpenMP threads and workers when running on CPU.')
 @click.option('-f', '--format-type', type=click.Choice(['path', 'xml', 'alto', 'page']), default='xml', show_default=True,
               help='Sets the training data format. In ALTO and PageXML mode all '
               'data is extracted from xml files containing both baselines and a '
@@ -26,6 +26,7 @@ import tempfile
 
 from PIL import Image
 from collections import Counter
+from functools import partial
 from typing import Optional, List, Union, Callable, Tuple, Dict
 from multiprocessing import Pool
 from kraken.lib import functional_im_transforms as F_t
@@ -91,6 +92,25 @@ def parse_path(path: Union[str, pathlib.Path], suffix: str = '.gt.txt', split=F_
     return {'image': path, 'lines': [{'text': gt}]}
 
 
+def _parse_doc(doc, parse_fn):
+    """
+    Parses a single input document, returning None for unparseable files or
+    files with missing images.
+    """
+    try:
+        data = parse_fn(doc)
+    except KrakenInputException:
+        logger.warning(f'Invalid input file {doc}')
+        return None
+    try:
+        with open(data['image'], 'rb') as fp:
+            Image.open(fp)
+    except FileNotFoundError as e:
+        logger.warning(f'Could not open file {e.filename} in {doc}')
+        return None
+    return data
+
+
 def build_binary_dataset(files: Optional[List[Union[str, pathlib.Path, Dict]]] = None,
                          output_file: Union[str, pathlib.Path] = None,
                          format_type: str = 'xml',
@@ -152,19 +172,16 @@ def build_binary_dataset(files: Optional[List[Union[str, pathlib.Path, Dict]]] =
 
     docs = []
     if parse_fn:
-        for doc in files:
-            try:
-                data = parse_fn(doc)
-            except KrakenInputException:
-                logger.warning(f'Invalid input file {doc}')
-                continue
-            try:
-                with open(data['image'], 'rb') as fp:
-                    Image.open(fp)
-            except FileNotFoundError as e:
-                logger.warning(f'Could not open file {e.filename} in {doc}')
-                continue
-            docs.append(data)
+        if num_workers and num_workers > 1:
+            # the XML parse is CPU-bound python work so it profits from the
+            # same process pool as the line extraction below; imap keeps the
+            # document order deterministic
+            logger.info(f'Spinning up processing pool with {num_workers} workers for parsing.')
+            with Pool(num_workers) as pool:
+                parsed = pool.imap(partial(_parse_doc, parse_fn=parse_fn), files)
+                docs = [data for data in parsed if data is not None]
+        else:
+            docs = [data for data in map(partial(_parse_doc, parse_fn=parse_fn), files) if data is not None]
         logger.info(f'Parsed {len(docs)} files.')
     else:
         docs = files.copy()
@@ -294,10 +311,13 @@ def build_binary_dataset(files: Optional[List[Union[str, pathlib.Path, Dict]]] =
 
         with pa.memory_map(tmp_file, 'rb') as source:
             logger.info(f'Rewriting output ({output_file}) to update metadata.')
-            ds = pa.ipc.open_file(source).read_all()
+            reader = pa.ipc.open_file(source)
             metadata['lines']['counts'] = dict(metadata['lines']['counts'])
             metadata['lines'] = json.dumps(metadata['lines'])
             schema = schema.with_metadata(metadata)
             with pa.OSFile(output_file, 'wb') as sink:
                 with pa.ipc.new_file(sink, schema) as writer:
-                    writer.write(ds)
+                    # copy the record batches over one at a time instead of
+                    # materializing the whole dataset as a single table
+                    for i in range(reader.num_record_batches):
+                        writer.write(reader.get_batch(i))
@@ -312,13 +312,23 @@ def global_align(seq1: Sequence[Any], seq2: Sequence[Any]) -> Tuple[int, List[st
     for i in range(-1, len(direction) - 1):
         direction[i + 1][0] = (i, 0)
     for i in range(1, len(cost)):
-        for j in range(1, len(cost[0])):
-            delcost = ((i - 1, j), cost[i - 1][j] + 1)
-            addcost = ((i, j - 1), cost[i][j - 1] + 1)
-            subcost = ((i - 1, j - 1), cost[i - 1][j - 1] + (seq1[i - 1] != seq2[j - 1]))
-            best = min(delcost, addcost, subcost, key=lambda x: x[1])
-            cost[i][j] = best[1]
-            direction[i][j] = best[0]
+        prev_row = cost[i - 1]
+        cur_row = cost[i]
+        dir_row = direction[i]
+        c1 = seq1[i - 1]
+        for j in range(1, len(cur_row)):
+            delcost = prev_row[j] + 1
+            addcost = cur_row[j - 1] + 1
+            subcost = prev_row[j - 1] + (c1 != seq2[j - 1])
+            if delcost <= addcost and delcost <= subcost:
+                cur_row[j] = delcost
+                dir_row[j] = (i - 1, j)
+            elif addcost <= subcost:
+                cur_row[j] = addcost
+                dir_row[j] = (i, j - 1)
+            else:
+                cur_row[j] = subcost
+                dir_row[j] = (i - 1, j - 1)
     d = cost[-1][-1]
     # backtrace
     algn1: List[Any] = []
@@ -328,15 +338,17 @@ def global_align(seq1: Sequence[Any], seq2: Sequence[Any]) -> Tuple[int, List[st
     while direction[i][j] != (-1, 0):
         k, m = direction[i][j]
         if k == i - 1 and m == j - 1:
-            algn1.insert(0, seq1[i - 1])
-            algn2.insert(0, seq2[j - 1])
+            algn1.append(seq1[i - 1])
+            algn2.append(seq2[j - 1])
         elif k < i:
-            algn1.insert(0, seq1[i - 1])
-            algn2.insert(0, '')
+            algn1.append(seq1[i - 1])
+            algn2.append('')
         elif m < j:
-            algn1.insert(0, '')
-            algn2.insert(0, seq2[j - 1])
+            algn1.append('')
+            algn2.append(seq2[j - 1])
         i, j = k, m
+    algn1.reverse()
+    algn2.reverse()
     return d, algn1, algn2
 
 
@@ -358,18 +370,24 @@ def compute_confusions(algn1: Sequence[str], algn2: Sequence[str]):
     with pkg_resources.resource_stream(__name__, 'scripts.json') as fp:
         script_map = json.load(fp)
 
+    script_cache: Dict[str, str] = {}
+
     def _get_script(c):
-        for s, e, n in script_map:
-            if ord(c) == s or (e and s <= ord(c) <= e):
-                return n
-        return 'Unknown'
+        script = script_cache.get(c)
+        if script is None:
+            script = 'Unknown'
+            for s, e, n in script_map:
+                if ord(c) == s or (e and s <= ord(c) <= e):
+                    script = n
+                    break
+            script_cache[c] = script
+        return script
 
     scripts: Dict[Tuple[str, str], int] = Counter()
     ins: Dict[Tuple[str, str], int] = Counter()
     dels: int = 0
     subs: Dict[Tuple[str, str], int] = Counter()
-    for u, v in zip(algn1, algn2):
-        counts[(u, v)] += 1
+    counts.update(zip(algn1, algn2))
     for k, v in counts.items():
         if k[0] == '':
             dels += v
@@ -1214,8 +1232,10 @@ class BaselineSet(Dataset):
             image = image.permute(1, 2, 0).numpy()
             target = target.permute(1, 2, 0).numpy()
             o = self.aug(image=image, mask=target)
-            image = torch.tensor(o['image']).permute(2, 0, 1)
-            target = torch.tensor(o['mask']).permute(2, 0, 1)
+            # from_numpy shares the augmentation output buffer instead of
+            # copying a full page image + mask stack
+            image = torch.from_numpy(o['image']).permute(2, 0, 1)
+            target = torch.from_numpy(o['mask']).permute(2, 0, 1)
         return image, target
 
     def __len__(self):
@@ -373,8 +373,9 @@ class RecognitionModel(pl.LightningModule):
         return {'chars': chars, 'error': error}
 
     def validation_epoch_end(self, outputs):
-        chars = torch.stack([x['chars'] for x in outputs]).sum()
-        error = torch.stack([x['error'] for x in outputs]).sum()
+        # running sums instead of stacking all step outputs into fresh tensors
+        chars = sum(x['chars'] for x in outputs)
+        error = sum(x['error'] for x in outputs)
         accuracy = (chars - error) / (chars + torch.finfo(torch.float).eps)
         if accuracy > self.best_metric:
             self.best_epoch = self.current_epoch
@@ -708,11 +709,15 @@ class SegmentationModel(pl.LightningModule):
     def validation_epoch_end(self, outputs):
         smooth = torch.finfo(torch.float).eps
 
-        intersections = torch.stack([x['intersections'] for x in outputs]).sum()
-        unions = torch.stack([x['unions'] for x in outputs]).sum()
-        corrects = torch.stack([x['corrects'] for x in outputs]).sum()
-        cls_cnt = torch.stack([x['cls_cnt'] for x in outputs]).sum()
-        all_n = torch.stack([x['all_n'] for x in outputs]).sum()
+        # accumulate running sums in one pass instead of materializing a
+        # (steps, C) tensor per metric
+        intersections = unions = corrects = cls_cnt = all_n = 0
+        for x in outputs:
+            intersections = intersections + x['intersections'].sum()
+            unions = unions + x['unions'].sum()
+            corrects = corrects + x['corrects'].sum()
+            cls_cnt = cls_cnt + x['cls_cnt'].sum()
+            all_n = all_n + x['all_n'].sum()
 
         # all_positives = tp + fp
         # actual_positives = tp + fn
@@ -19,6 +19,8 @@ import os.path
 import pathlib
 import logging
 
+import numpy as np
+
 from itertools import groupby
 from lxml import etree
 from os.path import dirname
@@ -146,14 +148,15 @@ def parse_xml(filename: Union[str, pathlib.Path]) -> Dict[str, Any]:
                        {...}],
              'regions': {'region_type_0': [[[x0, y0], ...], ...], ...}}
     """
-    with open(filename, 'rb') as fp:
-        try:
-            doc = etree.parse(fp)
-        except etree.XMLSyntaxError as e:
-            raise KrakenInputException(f'Parsing {filename} failed: {e}')
-    if doc.getroot().tag.endswith('alto'):
+    # only sniff the root tag here; the format-specific parsers read the
+    # whole document themselves so a full parse would do everything twice
+    try:
+        _, root = next(etree.iterparse(str(filename), events=('start',)))
+    except (etree.XMLSyntaxError, StopIteration) as e:
+        raise KrakenInputException(f'Parsing {filename} failed: {e}')
+    if root.tag.endswith('alto'):
         return parse_alto(filename)
-    elif doc.getroot().tag.endswith('PcGts'):
+    elif root.tag.endswith('PcGts'):
         return parse_page(filename)
     else:
         raise KrakenInputException(f'Unknown XML format in {filename}')
@@ -195,10 +198,11 @@ def parse_page(filename: Union[str, pathlib.Path]) -> Dict[str, Any]:
         return o
 
     def _parse_coords(coords):
-        points = [x for x in coords.split(' ')]
-        points = [int(c) for point in points for c in point.split(',')]
-        pts = zip(points[::2], points[1::2])
-        return [k for k, g in groupby(pts)]
+        points = np.array(coords.replace(',', ' ').split(), dtype=int).reshape(-1, 2)
+        # drop consecutive duplicate points
+        keep = np.ones(len(points), dtype=bool)
+        keep[1:] = (points[1:] != points[:-1]).any(axis=1)
+        return [tuple(x) for x in points[keep].tolist()]
 
     with open(filename, 'rb') as fp:
         base_dir = dirname(filename)
@@ -35,7 +35,7 @@ from scipy.ndimage.filters import gaussian_filter
 from scipy.ndimage.measurements import find_objects
 from scipy.ndimage.morphology import distance_transform_cdt, binary_closing
 
-from scipy.ndimage.interpolation import affine_transform, geometric_transform
+from scipy.ndimage.interpolation import affine_transform, map_coordinates
 from PIL import Image, ImageOps
 
 from typing import AnyStr
@@ -247,6 +247,18 @@ def _draw_on_surface(surface, font, language, text):
     return max(ink_rect.width, logical_rect.width), max(ink_rect.height, logical_rect.height)
 
 
+def _displace(arr, hs, ws, **kwargs):
+    """
+    Applies a dense displacement field to an array with bilinear
+    interpolation.
+
+    Vectorized replacement for geometric_transform with a per-pixel python
+    callback, which evaluates the callback once for every output pixel.
+    """
+    yx = np.indices(arr.shape, dtype=hs.dtype)
+    return map_coordinates(arr, (yx[0] + hs, yx[1] + ws), order=1, **kwargs)
+
+
 def ocropy_degrade(im, distort=1.0, dsigma=20.0, eps=0.03, delta=0.3, degradations=((0.5, 0.0, 0.5, 0.0),)):
     """
     Degrades and distorts a line using the same noise model used by ocropus.
@@ -302,11 +314,7 @@ def ocropy_degrade(im, distort=1.0, dsigma=20.0, eps=0.03, delta=0.3, degradatio
         ws = gaussian_filter(ws, dsigma)
         hs *= distort / np.amax(hs)
         ws *= distort / np.amax(ws)
-
-        def _f(p):
-            return (p[0] + hs[p[0], p[1]], p[1] + ws[p[0], p[1]])
-
-        a = geometric_transform(a, _f, output_shape=(h, w), order=1, mode='constant', cval=np.amax(a))
+        a = _displace(a, hs, ws, mode='constant', cval=np.amax(a))
     im = array2pil(a).convert('L')
     return im
 
@@ -396,11 +404,8 @@ def distort_line(im, distort=3.0, sigma=10, eps=0.03, delta=0.3):
     hs *= distort/np.amax(hs)
     ws *= distort/np.amax(ws)
 
-    def _f(p):
-        return (p[0] + hs[p[0], p[1]], p[1] + ws[p[0], p[1]])
-
     logger.debug('Performing geometric transformation')
-    im = array2pil(geometric_transform(line, _f, order=1, mode='nearest'))
+    im = array2pil(_displace(line, hs, ws, mode='nearest'))
     logger.debug('Cropping canvas to content box')
     im = im.crop(ImageOps.invert(im).getbbox())
     return im
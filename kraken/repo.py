@@ -27,6 +27,9 @@ import pathlib
 import logging
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 __all__ = ['get_model', 'get_description', 'get_listing', 'publish_model']
 
 logger = logging.getLogger(__name__)
@@ -48,27 +51,33 @@ def publish_model(model_file: [str, pathlib.Path] = None,
         access_token: Zenodo API access token
         callback: Function called for every 1024 octet chunk uploaded.
     """
-    fp = open(model_file, 'rb')
     total = len(model_file) + 4
     headers = {"Content-Type": "application/json"}
-    r = requests.post(f'{MODEL_REPO}deposit/depositions',
-                      params={'access_token': access_token}, json={},
-                      headers=headers)
+    # reuse one keepalive connection for the whole deposition dance instead
+    # of a TCP/TLS handshake per request
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.3)))
+    r = session.post(f'{MODEL_REPO}deposit/depositions',
+                     params={'access_token': access_token}, json={},
+                     headers=headers)
     r.raise_for_status()
     callback(total, 1)
     deposition_id = r.json()['id']
     data = {'filename': 'metadata.json'}
     files = {'file': ('metadata.json', json.dumps(metadata))}
-    r = requests.post(f'{MODEL_REPO}deposit/depositions/{deposition_id}/files',
-                      params={'access_token': access_token}, data=data,
-                      files=files)
+    r = session.post(f'{MODEL_REPO}deposit/depositions/{deposition_id}/files',
+                     params={'access_token': access_token}, data=data,
+                     files=files)
     r.raise_for_status()
     callback(total, 1)
     data = {'filename': metadata['name']}
-    files = {'file': fp}
-    r = requests.post(f'{MODEL_REPO}deposit/depositions/{deposition_id}/files',
-                      params={'access_token': access_token}, data=data,
-                      files=files)
+    # requests assembles multipart bodies (files=) fully in memory, so this
+    # still buffers the whole model file; true streaming would need
+    # requests-toolbelt or zenodo's newer bucket PUT API.
+    with open(model_file, 'rb') as fp:
+        r = session.post(f'{MODEL_REPO}deposit/depositions/{deposition_id}/files',
+                         params={'access_token': access_token}, data=data,
+                         files={'file': fp})
     r.raise_for_status()
     callback(total, 1)
     # fill zenodo metadata
@@ -87,14 +96,14 @@ def publish_model(model_file: [str, pathlib.Path] = None,
     # add link to training data to metadata
     if 'source' in metadata:
         data['metadata']['related_identifiers'] = [{'relation': 'isSupplementTo', 'identifier': metadata['source']}]
-    r = requests.put(f'{MODEL_REPO}deposit/depositions/{deposition_id}',
-                     params={'access_token': access_token},
-                     data=json.dumps(data),
-                     headers=headers)
+    r = session.put(f'{MODEL_REPO}deposit/depositions/{deposition_id}',
+                    params={'access_token': access_token},
+                    data=json.dumps(data),
+                    headers=headers)
     r.raise_for_status()
     callback(total, 1)
-    r = requests.post(f'{MODEL_REPO}deposit/depositions/{deposition_id}/actions/publish',
-                      params={'access_token': access_token})
+    r = session.post(f'{MODEL_REPO}deposit/depositions/{deposition_id}/actions/publish',
+                     params={'access_token': access_token})
     r.raise_for_status()
     callback(total, len(model_file))
     return r.json()['doi']
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import unittest
+import importlib.util
+import tempfile
+
+from lxml import etree
+from pathlib import Path
+
+from kraken.lib.xml import parse_page
+
+thisfile = Path(__file__).resolve().parent
+
+_mod_path = thisfile.parent / 'kraken' / 'contrib' / 'repolygonize.py'
+_spec = importlib.util.spec_from_file_location('repolygonize', _mod_path)
+repolygonize = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(repolygonize)
+
+PAGE_DOC = '''<?xml version="1.0" encoding="UTF-8"?>
+<PcGts xmlns="http://schema.primaresearch.org/PAGE/gts/pagecontent/2019-07-15">
+  <Page imageFilename="foo.png" imageWidth="100" imageHeight="100">
+    <TextRegion id="r0">
+      <Coords points="0,0 100,0 100,100 0,100"/>
+      <TextLine id="l0">
+        <Coords points="0,0 10,0 10,10 0,10"/>
+        <Baseline points="0,5 10,5"/>
+      </TextLine>
+      <TextLine id="l1">
+        <Coords points="0,20 10,20 10,30 0,30"/>
+        <Baseline points="0,25 10"/>
+      </TextLine>
+      <TextLine id="l2">
+        <Coords points="0,40 10,40 10,50 0,50"/>
+        <Baseline points="0,45 10,45"/>
+      </TextLine>
+    </TextRegion>
+  </Page>
+</PcGts>'''
+
+
+class TestRepolygonize(unittest.TestCase):
+
+    """
+    Tests of the PageXML polygon writeback in the repolygonize script.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.doc = Path(self.tmpdir.name) / 'page.xml'
+        self.doc.write_text(PAGE_DOC)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_page_writeback_skips_malformed_baselines(self):
+        """
+        Polygons stay aligned with parseable lines when a line with a
+        malformed baseline is interleaved.
+        """
+        # parse_page drops the line with the odd-length baseline (l1) so
+        # only two polygons are calculated for the document
+        seg = parse_page(self.doc)
+        self.assertEqual(len(seg['lines']), 2)
+        polygons = [[(0, 0), (10, 0), (10, 9), (0, 9)],
+                    [(0, 40), (10, 40), (10, 49), (0, 49)]]
+        repolygonize._repl_page(str(self.doc), polygons)
+        out = etree.parse(str(self.doc.with_name('page_rewrite.xml')))
+        coords = {line.get('id'): line.find('./{*}Coords').get('points')
+                  for line in out.iter('{*}TextLine')}
+        self.assertEqual(coords['l0'], '0,0 10,0 10,9 0,9')
+        # the malformed line keeps its original boundary
+        self.assertEqual(coords['l1'], '0,20 10,20 10,30 0,30')
+        self.assertEqual(coords['l2'], '0,40 10,40 10,49 0,49')
+
+    def test_page_writeback_aborts_on_mismatch(self):
+        """
+        No rewrite is produced when polygon and line counts disagree.
+        """
+        polygons = [[(0, 0), (10, 0), (10, 9), (0, 9)]]
+        repolygonize._repl_page(str(self.doc), polygons)
+        self.assertFalse(self.doc.with_name('page_rewrite.xml').exists())